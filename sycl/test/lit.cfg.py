@@ -6,13 +6,53 @@ import re
 import subprocess
 import tempfile
 import getpass
-from distutils.spawn import find_executable
+import json
+import shutil
 
 import lit.formats
 import lit.util
 
 from lit.llvm import llvm_config
 
+def _cached_pkgconfig(package):
+    """Return (returncode, flags) of `pkg-config --libs --cflags <package>`.
+
+    The result is cached in test_exec_root and reused as long as the same
+    pkg-config binary and search environment resolve to a .pc file that has
+    not been modified, to avoid spawning pkg-config on every lit invocation.
+    """
+    pkg_config = shutil.which("pkg-config")
+    if pkg_config is None:
+        return 1, ""
+    key = {"pkg_config": pkg_config}
+    for var in ("PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR", "PKG_CONFIG_SYSROOT_DIR"):
+        key[var] = os.environ.get(var)
+
+    cache_path = os.path.join(config.test_exec_root, f".{package}_flags.cache")
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached["key"] == key and os.path.getmtime(cached["pcfile"]) == cached["mtime"]:
+            return cached["returncode"], cached["flags"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    result = subprocess.run([pkg_config, "--libs", "--cflags", package], stdout=subprocess.PIPE)
+    flags = result.stdout.decode('utf-8')[:-1]
+    if result.returncode:
+        return result.returncode, flags
+
+    pcfiledir = subprocess.run([pkg_config, "--variable=pcfiledir", package], stdout=subprocess.PIPE)
+    pcfile = os.path.join(pcfiledir.stdout.decode('utf-8').strip(), f"{package}.pc")
+    try:
+        os.makedirs(config.test_exec_root, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump({"key": key, "pcfile": pcfile, "mtime": os.path.getmtime(pcfile),
+                       "returncode": result.returncode, "flags": flags}, f)
+    except OSError:
+        pass
+    return result.returncode, flags
+
 # Configuration file for the 'lit' test runner.
 
 # name: The name of this test suite.
@@ -46,42 +86,40 @@ llvm_config.with_system_environment(['PATH', 'OCL_ICD_FILENAMES', 'SYCL_DEVICE_A
 aie=lit_config.params.get('AIE', "off")
 vitis=lit_config.params.get('VITIS', "off")
 
-config.substitutions.append(('%python', '"%s"' % (sys.executable)))
-
 # Propagate extra environment variables
 if config.extra_environment:
-    lit_config.note("Extra environment variables")
-    for env_pair in config.extra_environment.split(','):
-        [var,val]=env_pair.split("=")
-        if val:
-           llvm_config.with_environment(var,val)
-           lit_config.note("\t"+var+"="+val)
-        else:
-           lit_config.note("\tUnset "+var)
-           llvm_config.with_environment(var,"")
+    # An empty value unsets the variable for the tests.
+    extra_env = dict(env_pair.split("=", 1) for env_pair in config.extra_environment.split(',') if env_pair)
+    config.environment.update(extra_env)
+    if lit_config.debug:
+        lit_config.note("Extra environment variables")
+        for var, val in extra_env.items():
+            lit_config.note("\t"+var+"="+val if val else "\tUnset "+var)
 
 config.environment['SYCL_VXX_PRINT_CMD'] = 'True'
 config.environment['SYCL_VXX_SERIALIZE_VITIS_COMP'] = 'True'
 config.environment['XRT_PCIE_HW_EMU_FORCE_SHUTDOWN'] = 'True'
 config.environment['SYCL_VXX_TEST_MODE'] = 'True'
 
+_system = platform.system()
+
 # Configure LD_LIBRARY_PATH or corresponding os-specific alternatives
 # Add 'libcxx' feature to filter out all SYCL abi tests when SYCL runtime
 # is built with llvm libcxx. This feature is added for Linux only since MSVC
 # CL compiler doesn't support to use llvm libcxx instead of MSVC STL.
-if platform.system() == "Linux":
+if _system == "Linux":
     config.available_features.add('linux')
     if config.sycl_use_libcxx == "ON":
         config.available_features.add('libcxx')
     llvm_config.with_system_environment('LD_LIBRARY_PATH')
     llvm_config.with_environment('LD_LIBRARY_PATH', config.sycl_libs_dir, append_path=True)
 
-elif platform.system() == "Windows":
+elif _system == "Windows":
     config.available_features.add('windows')
     llvm_config.with_system_environment('LIB')
     llvm_config.with_environment('LIB', config.sycl_libs_dir, append_path=True)
 
-elif platform.system() == "Darwin":
+elif _system == "Darwin":
     # FIXME: surely there is a more elegant way to instantiate the Xcode directories.
     llvm_config.with_system_environment('CPATH')
     llvm_config.with_environment('CPATH', "/Applications/Xcode.app/Contents/Developer/Toolchains/XcodeDefault.xctoolchain/usr/include/c++/v1", append_path=True)
@@ -90,34 +128,38 @@ elif platform.system() == "Darwin":
 
 llvm_config.with_environment('PATH', config.sycl_tools_dir, append_path=True)
 
-config.substitutions.append( ('%threads_lib', config.sycl_threads_lib) )
-config.substitutions.append( ('%sycl_libs_dir',  config.sycl_libs_dir ) )
-config.substitutions.append( ('%sycl_include',  config.sycl_include ) )
-config.substitutions.append( ('%sycl_source_dir', config.sycl_source_dir) )
-config.substitutions.append( ('%opencl_libs_dir',  config.opencl_libs_dir) )
-config.substitutions.append( ('%level_zero_include_dir',  config.level_zero_include_dir) )
-config.substitutions.append( ('%opencl_include_dir',  config.opencl_include_dir) )
-config.substitutions.append( ('%cuda_toolkit_include',  config.cuda_toolkit_include) )
-config.substitutions.append( ('%sycl_tools_src_dir',  config.sycl_tools_src_dir ) )
-config.substitutions.append( ('%llvm_build_lib_dir',  config.llvm_build_lib_dir ) )
-config.substitutions.append( ('%llvm_build_bin_dir',  config.llvm_build_bin_dir ) )
-config.substitutions.append( ('%clang_offload_bundler', f'{config.llvm_build_bin_dir}clang-offload-bundler') )
-
 llvm_symbolizer = os.path.join(config.llvm_build_bin_dir, 'llvm-symbolizer')
 llvm_config.with_environment('LLVM_SYMBOLIZER_PATH', llvm_symbolizer)
 
-config.substitutions.append( ('%fsycl-host-only', '-std=c++17 -Xclang -fsycl-is-host -isystem %s -isystem %s -isystem %s -isystem %s' % (config.sycl_include, config.level_zero_include_dir, config.opencl_include_dir, config.sycl_include + '/sycl/') ) )
-config.substitutions.append( ('%sycl_lib', ' -lsycl6' if platform.system() == "Windows" else '-lsycl') )
-
-llvm_config.add_tool_substitutions(['llvm-spirv'], [config.sycl_tools_dir])
-
 backend=lit_config.params.get('SYCL_BE', "PI_OPENCL")
 lit_config.note("Backend (SYCL_BE): {}".format(backend))
-config.substitutions.append( ('%sycl_be', backend) )
 
 triple=lit_config.params.get('SYCL_TRIPLE', 'spir64-unknown-unknown')
 lit_config.note("Triple: {}".format(triple))
-config.substitutions.append( ('%sycl_triple',  triple ) )
+
+# Order matters: lit applies substitutions in sequence, so '%sycl_libs_dir'
+# has to come before its prefix '%sycl_lib'.
+config.substitutions.extend([
+    ('%python', '"%s"' % (sys.executable)),
+    ('%threads_lib', config.sycl_threads_lib),
+    ('%sycl_libs_dir', config.sycl_libs_dir),
+    ('%sycl_include', config.sycl_include),
+    ('%sycl_source_dir', config.sycl_source_dir),
+    ('%opencl_libs_dir', config.opencl_libs_dir),
+    ('%level_zero_include_dir', config.level_zero_include_dir),
+    ('%opencl_include_dir', config.opencl_include_dir),
+    ('%cuda_toolkit_include', config.cuda_toolkit_include),
+    ('%sycl_tools_src_dir', config.sycl_tools_src_dir),
+    ('%llvm_build_lib_dir', config.llvm_build_lib_dir),
+    ('%llvm_build_bin_dir', config.llvm_build_bin_dir),
+    ('%clang_offload_bundler', f'{config.llvm_build_bin_dir}clang-offload-bundler'),
+    ('%fsycl-host-only', '-std=c++17 -Xclang -fsycl-is-host -isystem %s -isystem %s -isystem %s -isystem %s' % (config.sycl_include, config.level_zero_include_dir, config.opencl_include_dir, config.sycl_include + '/sycl/')),
+    ('%sycl_lib', ' -lsycl6' if _system == "Windows" else '-lsycl'),
+    ('%sycl_be', backend),
+    ('%sycl_triple', triple),
+])
+
+llvm_config.add_tool_substitutions(['llvm-spirv'], [config.sycl_tools_dir])
 
 additional_flags = config.sycl_clang_extra_flags.split(' ')
 
@@ -152,34 +194,33 @@ filter=lit_config.params.get('SYCL_PLUGIN', "opencl")
 
 lit_config.note("Filter: {}".format(filter))
 
-acc_run_substitute=f"env SYCL_DEVICE_FILTER={filter} "
+acc_run_parts = ["env", f"SYCL_DEVICE_FILTER={filter}"]
 extra_compile_flags=""
 if vitis != "off" and vitis != "cpu":
     # Clean up the named semaphore in case the previous test did not clean up properly.
     # If someone tries to run multiple tests on the same machine this could cause issues.
-    os.system("rm -rf /dev/shm/sem.sycl_vxx.py")
+    try:
+        os.unlink("/dev/shm/sem.sycl_vxx.py")
+    except FileNotFoundError:
+        pass
     # xrt doesn't deal well with multiple executables using it concurrently (at the time of writing).
     # The details are at https://xilinx.github.io/XRT/master/html/multiprocess.html
     # so we wrap every use of XRT inside an file lock.
     xrt_lock = f"{tempfile.gettempdir()}/xrt-{getpass.getuser()}.lock"
-    acc_run_substitute+= "flock --exclusive " + xrt_lock + " "
     if os.path.exists(xrt_lock):
         os.remove(xrt_lock)
-    acc_run_substitute="env --unset=XCL_EMULATION_MODE " + acc_run_substitute
-    # hw_emu is very slow so it has a higher timeout.
-    acc_run_substitute += "unshare --pid --map-current-user --kill-child "
-    if "hw_emu" not in triple:
-        acc_run_substitute+= "timeout 300 env "
-    else:
-        acc_run_substitute+= "timeout 600 env "
+    acc_run_parts = ["env", "--unset=XCL_EMULATION_MODE"] + acc_run_parts
+    acc_run_parts += ["flock", "--exclusive", xrt_lock,
+                      "unshare", "--pid", "--map-current-user", "--kill-child",
+                      # hw_emu is very slow so it has a higher timeout.
+                      "timeout", "600" if "hw_emu" in triple else "300", "env"]
 if vitis == "cpu":
     extra_compile_flags=" -fsyntax-only "
     # This will print the command instead of executing it
     # Since nothing is being fully compiled nothing should ne executed
-    acc_run_substitute="echo "
+    acc_run_parts = ["echo"]
 
-config.substitutions.append( ('%ACC_RUN_PLACEHOLDER', acc_run_substitute) )
-config.substitutions.append( ('%EXTRA_COMPILE_FLAGS', extra_compile_flags) )
+acc_run_substitute = " ".join(acc_run_parts) + " "
 
 timeout = 600
 if vitis == "off":
@@ -189,22 +230,18 @@ else:
     if vitis == "cpu":
         config.available_features.add("vitis_cpu")
     required_env = ['HOME', 'USER', 'XILINX_XRT', 'XILINX_PLATFORM', 'EMCONFIG_PATH', 'LIBRARY_PATH', 'XILINX_VITIS']
-    has_error=False
     config.available_features.add("vitis")
     feat_list = ",".join(config.available_features)
     lit_config.note(f"Features: {feat_list}")
-    pkg_opencv4 = subprocess.run(["pkg-config", "--libs", "--cflags", "opencv4"], stdout=subprocess.PIPE)
-    has_opencv4 = not pkg_opencv4.returncode
+    opencv4_returncode, opencv4_flags = _cached_pkgconfig("opencv4")
+    has_opencv4 = not opencv4_returncode
     lit_config.note("has opencv4: {}".format(has_opencv4))
     if has_opencv4:
         config.available_features.add("opencv4")
-        config.substitutions.append( ('%opencv4_flags', pkg_opencv4.stdout.decode('utf-8')[:-1]) )
-    for env in required_env:
-        if env not in os.environ:
-            lit_config.note("missing environnement variable: {}".format(env))
-            has_error=True
-    if has_error:
-        lit_config.error("Can't configure tests for Vitis")
+        config.substitutions.append( ('%opencv4_flags', opencv4_flags) )
+    missing_env = [env for env in required_env if env not in os.environ]
+    if missing_env:
+        lit_config.error("Can't configure tests for Vitis, missing environment variables: {}".format(", ".join(missing_env)))
     llvm_config.with_system_environment(required_env)
     if vitis == "only":
         config.excludes += ['basic_tests', 'extentions', 'online_compiler', 'plugins']
@@ -225,10 +262,16 @@ else:
     run_if_not_cpu="echo"
     if vitis != "cpu":
         run_if_not_cpu = ""
-    config.substitutions.append( ('%run_if_hw', run_if_hw) )
-    config.substitutions.append( ('%run_if_hw_emu', run_if_hw_emu) )
-    config.substitutions.append( ('%run_if_sw_emu', run_if_sw_emu) )
-    config.substitutions.append( ('%run_if_not_cpu', run_if_not_cpu) )
+    # These placeholders are only used by Vitis tests, so they are not
+    # registered at all when Vitis is off.
+    config.substitutions.extend([
+        ('%ACC_RUN_PLACEHOLDER', acc_run_substitute),
+        ('%EXTRA_COMPILE_FLAGS', extra_compile_flags),
+        ('%run_if_hw', run_if_hw),
+        ('%run_if_hw_emu', run_if_hw_emu),
+        ('%run_if_sw_emu', run_if_sw_emu),
+        ('%run_if_not_cpu', run_if_not_cpu),
+    ])
 
 if aie == "off":
     config.excludes += ['aie', 'acap']
@@ -250,8 +293,11 @@ else:
         if "ACAP_COLLECT_TEST_BIN_PATH" in os.environ:
             ACAP_COLLECT_TEST_BIN_PATH = os.environ["ACAP_COLLECT_TEST_BIN_PATH"]
             lit_config.note(f"collecting results into: {ACAP_COLLECT_TEST_BIN_PATH}")
-            subprocess.run(["rm", "-rf", f"{ACAP_COLLECT_TEST_BIN_PATH}"])
-            subprocess.run(["mkdir", f"{ACAP_COLLECT_TEST_BIN_PATH}"])
+            if os.path.islink(ACAP_COLLECT_TEST_BIN_PATH) or os.path.isfile(ACAP_COLLECT_TEST_BIN_PATH):
+                os.unlink(ACAP_COLLECT_TEST_BIN_PATH)
+            elif os.path.exists(ACAP_COLLECT_TEST_BIN_PATH):
+                shutil.rmtree(ACAP_COLLECT_TEST_BIN_PATH)
+            os.makedirs(ACAP_COLLECT_TEST_BIN_PATH)
             add_acap_result = f"cp --target-directory={ACAP_COLLECT_TEST_BIN_PATH} "
             config.substitutions.append( ('%add_acap_result', add_acap_result))
     if "AIE_RUN_ON_DEVICE_SH" in os.environ:
@@ -265,13 +311,9 @@ else:
         config.substitutions.append( ('%if_run_on_device', " "))
     llvm_config.with_environment('ACAP_MAKE_IN_PARALLEL', '1')
     required_env = ['HOME', 'USER', 'XILINXD_LICENSE_FILE', 'LM_LICENSE_FILE', 'RDI_INTERNAL_ALLOW_PARTIAL_DATA', 'AIE_ROOT', 'CHESSROOT']
-    has_error=False
-    for env in required_env:
-        if env not in os.environ:
-            lit_config.note("missing environnement variable: {}".format(env))
-            has_error=True
-    if has_error:
-        lit_config.error("Can't configure tests for AIE or ACAP")
+    missing_env = [env for env in required_env if env not in os.environ]
+    if missing_env:
+        lit_config.error("Can't configure tests for AIE or ACAP, missing environment variables: {}".format(", ".join(missing_env)))
     llvm_config.with_system_environment(required_env)
 
 # Set timeout for test = 10 mins